@@ -2,11 +2,13 @@ import subprocess
 import os
 import json
 import logging
+import urllib.request
 import sys
+import time
 
 sys.path.insert(0, '/opt/awscli')
 import botocore.session
-from botocore.vendored import requests
+from botocore.config import Config
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -15,19 +17,31 @@ CFN_SUCCESS = "SUCCESS"
 CFN_FAILED = "FAILED"
 
 # these are coming from the kubectl layer
-os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
+if '/opt/kubectl' not in os.environ.get('PATH', ''):
+    os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
 
 outdir = os.environ.get('TEST_OUTDIR', '/tmp')
 kubeconfig = os.path.join(outdir, 'kubeconfig')
 
+# reused across warm invocations of the same container. the client config only
+# uses options understood by the older botocore bundled in the kubectl layer
+# (which takes precedence on sys.path), so no retry "mode" or tcp_keepalive.
+session = botocore.session.get_session()
+eks = session.create_client('eks', config=Config(
+    retries={ 'max_attempts': 5 },
+    connect_timeout=3,
+    read_timeout=30
+))
+
 def handler(event, context):
 
     def cfn_error(message=None):
-        logger.error("| cfn_error: %s" % message)
+        logger.error("| cfn_error: %s", message)
         cfn_send(event, context, CFN_FAILED, reason=message)
 
     try:
-        logger.info(json.dumps(event))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(event))
 
         stack_id = event['StackId']
         request_id = event['RequestId'] # used to generate cluster name
@@ -41,10 +55,8 @@ def handler(event, context):
         def new_cluster_name():
             return "cluster-%s" % request_id
 
-        logger.info(json.dumps(config))
-
-        session = botocore.session.get_session()
-        eks = session.create_client('eks');
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(config))
 
         # determine cluster name: the it can either be explicitly
         # specified in the resource properties or brought in from
@@ -56,29 +68,34 @@ def handler(event, context):
             elif request_type == 'Create': cluster_name = new_cluster_name()
             else: raise Exception("unexpected error. cannot determine cluster name")
         config['name'] = cluster_name
-        logger.info("request: %s" % config)
+        logger.info("request: %s", config)
 
         # extract additional options
         resourcesVpcConfig = config.get('resourcesVpcConfig', None)
         roleArn = config.get('roleArn', None)
         version = config.get('version', None)
+        old_resourcesVpcConfig = old_config.get('resourcesVpcConfig', None)
+        old_roleArn = old_config.get('roleArn', None)
 
         def should_replace_cluster():
-            logger.info("old config: %s" % json.dumps(old_config))
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("old config: %s", json.dumps(old_config))
 
+            # common case: none of the replacement properties changed
             old_name = physical_id
+            if (old_name, old_resourcesVpcConfig, old_roleArn) == (cluster_name, resourcesVpcConfig, roleArn):
+                return False
+
             if old_name != cluster_name:
-                logger.info("'name' change requires replacement (old=%s, new=%s)" % (old_name, cluster_name))
+                logger.info("'name' change requires replacement (old=%s, new=%s)", old_name, cluster_name)
                 return True
 
-            old_resourcesVpcConfig = old_config.get('resourcesVpcConfig', None)
             if old_resourcesVpcConfig != resourcesVpcConfig:
-                logger.info("'resourcesVpcConfig' change requires replacement (old=%s, new=%s)" % (old_resourcesVpcConfig, resourcesVpcConfig))
+                logger.info("'resourcesVpcConfig' change requires replacement (old=%s, new=%s)", old_resourcesVpcConfig, resourcesVpcConfig)
                 return True
-            
-            old_roleArn = old_config.get('roleArn', None)
+
             if old_roleArn != roleArn:
-                logger.info("'roleArn' change requires replacement (old=%s, new=%s)" % (old_roleArn, roleArn))
+                logger.info("'roleArn' change requires replacement (old=%s, new=%s)", old_roleArn, roleArn)
                 return True
             
             return False
@@ -94,13 +111,12 @@ def handler(event, context):
             return
 
         if request_type == 'Create':
-            logger.info("creating cluster %s" % cluster_name)
+            logger.info("creating cluster %s", cluster_name)
             resp = eks.create_cluster(**config)
-            logger.info("create response: %s" % resp)
+            logger.info("create response: %s", resp)
         elif request_type == 'Update':
             # physical_id is always defined for "update"
-            logger.info("updating cluster %s" % physical_id)
-            current_state = eks.describe_cluster(name=physical_id)['cluster']
+            logger.info("updating cluster %s", physical_id)
 
             # changes to "name", "resourcesVpcConfig" and "roleArn" all require replacement
             # according to the cloudformation spec, so if one of these change, we basically need to create
@@ -112,42 +128,38 @@ def handler(event, context):
                     cluster_name = new_cluster_name()
                     config['name'] = cluster_name
 
-                logger.info("replacing cluster %s with a new cluster %s" % (physical_id, cluster_name))
+                logger.info("replacing cluster %s with a new cluster %s", physical_id, cluster_name)
                 resp = eks.create_cluster(**config)
-                logger.info("create (replacement) response: %s" % resp)
+                logger.info("create (replacement) response: %s", resp)
             else:
                 # version change - we can do that without replacement
                 old_version = old_config.get('version', None)
                 if (old_version is None) and (version is None):
                     logger.info("no version change")
                 else:
+                    # only needed here, so replacements don't pay for the extra api call
+                    current_state = eks.describe_cluster(name=physical_id)['cluster']
                     old_version_actual = current_state['version']
                     if version != old_version_actual:
                         if version is None:
                             raise Exception("Version cannot be changed from a specific value (%s) to undefined" % old_version)
 
                         resp = eks.update_cluster_version(name=cluster_name,version=version)
-                        logger.info("update response: %s" % resp)
+                        logger.info("update response: %s", resp)
         else:
             raise Exception("Invalid request type %s" % request_type)
 
         # wait for the cluster to become active (13min timeout)
         logger.info('waiting for cluster to become active...')
-        waiter = eks.get_waiter('cluster_active')
-        waiter.wait(name=cluster_name, WaiterConfig={
-            'Delay': 30,
-            'MaxAttempts': 26
-        })
-
-        resp = eks.describe_cluster(name=cluster_name)
-        logger.info("describe response: %s" % resp)
+        resp = wait_for_cluster_active(cluster_name, delay=30, max_attempts=26)
+        logger.info("describe response: %s", resp)
         attrs = {
             'Name': resp['cluster']['name'],
             'Endpoint': resp['cluster']['endpoint'],
             'Arn': resp['cluster']['arn'],
             'CertificateAuthorityData': resp['cluster']['certificateAuthority']['data']
         }
-        logger.info("attributes: %s" % attrs)
+        logger.info("attributes: %s", attrs)
         cfn_send(event, context, CFN_SUCCESS, responseData=attrs, physicalResourceId=cluster_name)
 
     except:
@@ -155,6 +167,21 @@ def handler(event, context):
         logger.exception(e)
         cfn_error(str(e))
 
+# polls DescribeCluster until the cluster is ACTIVE and returns the last response, so
+# callers don't need to describe the cluster again (same semantics as the "cluster_active" waiter)
+def wait_for_cluster_active(cluster_name, delay, max_attempts):
+    for attempt in range(max_attempts):
+        resp = eks.describe_cluster(name=cluster_name)
+        status = resp['cluster']['status']
+        if status == 'ACTIVE':
+            return resp
+        if status in ('FAILED', 'DELETING'):
+            raise Exception("cluster %s entered an unexpected state: %s" % (cluster_name, status))
+        if attempt < max_attempts - 1:
+            time.sleep(delay)
+
+    raise Exception("timed out waiting for cluster %s to become active" % cluster_name)
+
 def resp_to_attriburtes(resp):
     return
 
@@ -180,8 +207,9 @@ def cfn_send(event, context, responseStatus, responseData={}, physicalResourceId
     responseBody['NoEcho'] = noEcho
     responseBody['Data'] = responseData
 
-    body = json.dumps(responseBody)
-    logger.info("| response body:\n" + body)
+    body = json.dumps(responseBody).encode('utf-8')
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("| response body:\n%s", body.decode('utf-8'))
 
     headers = {
         'content-type' : '',
@@ -189,8 +217,9 @@ def cfn_send(event, context, responseStatus, responseData={}, physicalResourceId
     }
 
     try:
-        response = requests.put(responseUrl, data=body, headers=headers)
-        logger.info("| status code: " + response.reason)
+        request = urllib.request.Request(responseUrl, data=body, headers=headers, method='PUT')
+        response = urllib.request.urlopen(request, timeout=30)
+        logger.info("| status code: %s", response.reason)
     except Exception as e:
         logger.error("| unable to send response to CloudFormation")
         logger.exception(e)
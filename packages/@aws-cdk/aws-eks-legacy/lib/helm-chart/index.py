@@ -1,31 +1,39 @@
+import collections
 import subprocess
 import os
 import json
 import logging
-import boto3
+import urllib.request
 from uuid import uuid4
-from botocore.vendored import requests
+
+import botocore.session
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # these are coming from the kubectl layer
-os.environ['PATH'] = '/opt/helm:/opt/awscli:' + os.environ['PATH']
+if '/opt/helm' not in os.environ.get('PATH', ''):
+    os.environ['PATH'] = '/opt/helm:/opt/awscli:' + os.environ['PATH']
 
 outdir = os.environ.get('TEST_OUTDIR', '/tmp')
 kubeconfig = os.path.join(outdir, 'kubeconfig')
 
+# reused across warm invocations of the same container
+session = botocore.session.get_session()
+eks = session.create_client('eks')
+
 CFN_SUCCESS = "SUCCESS"
 CFN_FAILED = "FAILED"
 
 def handler(event, context):
 
     def cfn_error(message=None):
-        logger.error("| cfn_error: %s" % message)
+        logger.error("| cfn_error: %s", message)
         cfn_send(event, context, CFN_FAILED, reason=message)
 
     try:
-        logger.info(json.dumps(event))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(event))
 
         request_type = event['RequestType']
         props = event['ResourceProperties']
@@ -41,19 +49,22 @@ def handler(event, context):
         if cluster_name is None:
             cfn_error("CLUSTER_NAME is missing in environment")
             return
-        
-        subprocess.check_call([ 'aws', 'eks', 'update-kubeconfig',
-            '--name', cluster_name,
-            '--kubeconfig', kubeconfig
-        ])
 
-        # Write out the values to a file and include them with the install and upgrade
+        write_kubeconfig(cluster_name)
+
+        # Write out the values to a file and include them with the install and upgrade.
+        # values are passed as JSON, which helm accepts as YAML as-is.
         values_file = None
         if not request_type == "Delete" and not values_text is None:
-            values = json.loads(values_text)
             values_file = os.path.join(outdir, 'values.yaml')
-            with open(values_file, "w") as f:
-                f.write(json.dumps(values, indent=2))
+            fd = os.open(values_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                # os.write may write fewer bytes than requested
+                view = memoryview(values_text.encode('utf-8'))
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
 
         if request_type == 'Create' or request_type == 'Update':
             helm('upgrade', release, chart, repository, values_file, namespace, version)
@@ -61,7 +72,7 @@ def handler(event, context):
             try:
                 helm('uninstall', release, namespace=namespace)
             except Exception as e:
-                logger.info("delete error: %s" % e)
+                logger.info("delete error: %s", e)
 
         # if we are creating a new resource, allocate a physical id for it
         # otherwise, we expect physical id to be relayed by cloudformation
@@ -81,28 +92,73 @@ def handler(event, context):
         logger.exception(e)
         cfn_error(str(e))
 
+def write_kubeconfig(cluster_name):
+    # equivalent to `aws eks update-kubeconfig`, without spawning the aws cli.
+    # kubeconfig is YAML, and JSON is valid YAML.
+    cluster = eks.describe_cluster(name=cluster_name)['cluster']
+    cluster_arn = cluster['arn']
+    config = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{
+            'name': cluster_arn,
+            'cluster': {
+                'server': cluster['endpoint'],
+                'certificate-authority-data': cluster['certificateAuthority']['data']
+            }
+        }],
+        'contexts': [{
+            'name': cluster_arn,
+            'context': { 'cluster': cluster_arn, 'user': cluster_arn }
+        }],
+        'current-context': cluster_arn,
+        'preferences': {},
+        'users': [{
+            'name': cluster_arn,
+            'user': {
+                'exec': {
+                    'apiVersion': 'client.authentication.k8s.io/v1alpha1',
+                    'command': 'aws',
+                    'args': [
+                        '--region', eks.meta.region_name,
+                        'eks', 'get-token',
+                        '--cluster-name', cluster_name
+                    ]
+                }
+            }
+        }]
+    }
+
+    with open(kubeconfig, 'w') as f:
+        f.write(json.dumps(config, indent=2))
+
 def helm(verb, release, chart = None, repo = None, file = None, namespace = None, version = None):
-    import subprocess
     try:
-        cmnd = ['helm', verb, release]
-        if not chart is None:
-            cmnd.append(chart)
+        # (option, value) pairs; values that are None are omitted
+        options = (('--repo', repo), ('--values', file), ('--version', version), ('--namespace', namespace))
+
+        cmnd = ['helm', verb, release] + ([chart] if chart is not None else [])
         if verb == 'upgrade':
             cmnd.append('--install')
-        if not repo is None:
-            cmnd.extend(['--repo', repo])
-        if not file is None:
-            cmnd.extend(['--values', file])
-        if not version is None:
-            cmnd.extend(['--version', version])
-        if not namespace is None:
-            cmnd.extend(['--namespace', namespace])
-        cmnd.extend(['--kubeconfig', kubeconfig])
-        output = subprocess.check_output(cmnd, stderr=subprocess.STDOUT, cwd=outdir)
-        logger.info(output)
+        cmnd += [arg for option, value in options if value is not None for arg in (option, value)]
+        cmnd += ['--kubeconfig', kubeconfig]
+        stream_output(cmnd)
     except subprocess.CalledProcessError as exc:
         raise Exception(exc.output)
 
+def stream_output(cmnd):
+    # log helm output as it is produced and only keep the tail around for
+    # error reporting, so memory stays bounded regardless of chart size.
+    tail = collections.deque(maxlen=200)
+    with subprocess.Popen(cmnd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=outdir, bufsize=1, encoding='utf-8', errors='replace') as proc:
+        for line in proc.stdout:
+            line = line.rstrip()
+            logger.info(line)
+            tail.append(line)
+        rc = proc.wait()
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmnd, output='\n'.join(tail))
+
 #---------------------------------------------------------------------------------------------------
 # sends a response to cloudformation
 def cfn_send(event, context, responseStatus, responseData={}, physicalResourceId=None, noEcho=False, reason=None):
@@ -120,8 +176,9 @@ def cfn_send(event, context, responseStatus, responseData={}, physicalResourceId
     responseBody['NoEcho'] = noEcho
     responseBody['Data'] = responseData
 
-    body = json.dumps(responseBody)
-    logger.info("| response body:\n" + body)
+    body = json.dumps(responseBody).encode('utf-8')
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("| response body:\n%s", body.decode('utf-8'))
 
     headers = {
         'content-type' : '',
@@ -129,8 +186,9 @@ def cfn_send(event, context, responseStatus, responseData={}, physicalResourceId
     }
 
     try:
-        response = requests.put(responseUrl, data=body, headers=headers)
-        logger.info("| status code: " + response.reason)
+        request = urllib.request.Request(responseUrl, data=body, headers=headers, method='PUT')
+        response = urllib.request.urlopen(request, timeout=30)
+        logger.info("| status code: %s", response.reason)
     except Exception as e:
         logger.error("| unable to send response to CloudFormation")
         logger.exception(e)
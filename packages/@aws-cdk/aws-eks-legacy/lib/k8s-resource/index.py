@@ -10,7 +10,8 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # these are coming from the kubectl layer
-os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
+if '/opt/kubectl' not in os.environ.get('PATH', ''):
+    os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
 
 outdir = os.environ.get('TEST_OUTDIR', '/tmp')
 kubeconfig = os.path.join(outdir, 'kubeconfig')
@@ -39,10 +40,14 @@ def handler(event, context):
             return
 
         # "log in" to the cluster
-        subprocess.check_call([ 'aws', 'eks', 'update-kubeconfig',
-            '--name', cluster_name,
-            '--kubeconfig', kubeconfig
-        ])
+        try:
+            subprocess.run([ 'aws', 'eks', 'update-kubeconfig',
+                '--name', cluster_name,
+                '--kubeconfig', kubeconfig
+            ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        except subprocess.CalledProcessError as exc:
+            logger.error(exc.stderr)
+            raise
 
         # write resource manifests in sequence: { r1 }{ r2 }{ r3 } (this is how
         # a stream of JSON objects can be included in a k8s manifest).
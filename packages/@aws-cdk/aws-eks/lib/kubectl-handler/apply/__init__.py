@@ -7,7 +7,8 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # these are coming from the kubectl layer
-os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
+if '/opt/kubectl' not in os.environ.get('PATH', ''):
+    os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
 
 outdir = os.environ.get('TEST_OUTDIR', '/tmp')
 kubeconfig = os.path.join(outdir, 'kubeconfig')
@@ -34,7 +35,11 @@ def apply_handler(event, context):
         '--kubeconfig', kubeconfig
     ]
     logger.info(f'Running command: {cmd}')
-    subprocess.check_call(cmd)
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    except subprocess.CalledProcessError as exc:
+        logger.error(exc.stderr)
+        raise
 
     if os.path.isfile(kubeconfig):
         os.chmod(kubeconfig, 0o600)
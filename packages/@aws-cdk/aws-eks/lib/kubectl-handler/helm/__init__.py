@@ -1,17 +1,39 @@
+import base64
+import collections
 import json
 import logging
 import os
+import random
 import subprocess
+import time
+
+import botocore.session
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # these are coming from the kubectl layer
-os.environ['PATH'] = '/opt/helm:/opt/awscli:' + os.environ['PATH']
+if '/opt/helm' not in os.environ.get('PATH', ''):
+    os.environ['PATH'] = '/opt/helm:/opt/awscli:' + os.environ['PATH']
 
 outdir = os.environ.get('TEST_OUTDIR', '/tmp')
 kubeconfig = os.path.join(outdir, 'kubeconfig')
 
+# created on first use, since this module is imported for every kubectl resource
+# type and only helm charts need them. reused across warm invocations.
+eks = None
+sts = None
+
+# EKS rejects a token 15 minutes after it was signed (`aws eks get-token` reports
+# 14). helm keeps using the token for as long as it runs, which is at most its
+# default 5 minute --timeout when the static token is used, so a cached token is
+# only reused while it is young enough to outlive that.
+TOKEN_LIFETIME_SECONDS = 14 * 60
+HELM_DEFAULT_TIMEOUT_SECONDS = 5 * 60
+
+# (role_arn, cluster_name) -> (token, time it was signed)
+tokens = {}
+
 
 def helm_handler(event, context):
     logger.info(json.dumps(event))
@@ -33,22 +55,24 @@ def helm_handler(event, context):
     values_text  = props.get('Values', None)
 
     # "log in" to the cluster
-    subprocess.check_call([ 'aws', 'eks', 'update-kubeconfig',
-        '--role-arn', role_arn,
-        '--name', cluster_name,
-        '--kubeconfig', kubeconfig
-    ])
+    write_kubeconfig(cluster_name, role_arn, wait, timeout)
 
     if os.path.isfile(kubeconfig):
         os.chmod(kubeconfig, 0o600)
 
-    # Write out the values to a file and include them with the install and upgrade
+    # Write out the values to a file and include them with the install and upgrade.
+    # values are passed as JSON, which helm accepts as YAML as-is.
     values_file = None
     if not request_type == "Delete" and not values_text is None:
-        values = json.loads(values_text)
         values_file = os.path.join(outdir, 'values.yaml')
-        with open(values_file, "w") as f:
-            f.write(json.dumps(values, indent=2))
+        fd = os.open(values_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            # os.write may write fewer bytes than requested
+            view = memoryview(values_text.encode('utf-8'))
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
 
     if request_type == 'Create' or request_type == 'Update':
         helm('upgrade', release, chart, repository, values_file, namespace, version, wait, timeout, create_namespace)
@@ -58,42 +82,136 @@ def helm_handler(event, context):
         except Exception as e:
             logger.info("delete error: %s" % e)
 
+def write_kubeconfig(cluster_name, role_arn, wait, timeout):
+    # equivalent to `aws eks update-kubeconfig`, without spawning the aws cli.
+    # kubeconfig is YAML, and JSON is valid YAML.
+    eks = eks_client()
+    cluster = eks.describe_cluster(name=cluster_name)['cluster']
+    cluster_arn = cluster['arn']
+
+    if wait or timeout is not None:
+        # with "--wait" or a custom "--timeout" (up to 15m), helm can keep running past
+        # the lifetime of a static token, so let it obtain fresh tokens through
+        # `aws eks get-token` instead.
+        user = {
+            'exec': {
+                'apiVersion': 'client.authentication.k8s.io/v1alpha1',
+                'command': 'aws',
+                'args': [
+                    '--region', eks.meta.region_name,
+                    'eks', 'get-token',
+                    '--cluster-name', cluster_name,
+                    '--role', role_arn
+                ]
+            }
+        }
+    else:
+        user = { 'token': get_token(role_arn, cluster_name) }
+
+    config = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{
+            'name': cluster_arn,
+            'cluster': {
+                'server': cluster['endpoint'],
+                'certificate-authority-data': cluster['certificateAuthority']['data']
+            }
+        }],
+        'contexts': [{
+            'name': cluster_arn,
+            'context': { 'cluster': cluster_arn, 'user': cluster_arn }
+        }],
+        'current-context': cluster_arn,
+        'preferences': {},
+        'users': [{
+            'name': cluster_arn,
+            'user': user
+        }]
+    }
+
+    with open(kubeconfig, 'w') as f:
+        f.write(json.dumps(config, indent=2))
+
+# returns a cached token for the role and cluster if it can still outlive a helm
+# run with the default timeout, otherwise signs a new one.
+def get_token(role_arn, cluster_name):
+    key = (role_arn, cluster_name)
+    now = time.time()
+    cached = tokens.get(key)
+    if cached is not None:
+        token, signed_at = cached
+        if now - signed_at + HELM_DEFAULT_TIMEOUT_SECONDS < TOKEN_LIFETIME_SECONDS:
+            return token
+
+    token = sign_token(role_arn, cluster_name)
+    tokens[key] = (token, now)
+    return token
+
+# equivalent to `aws eks get-token --role-arn`: a pre-signed sts:GetCallerIdentity
+# url, issued for the kubectl role and bound to the cluster through the
+# "x-k8s-aws-id" header.
+def sign_token(role_arn, cluster_name):
+    creds = sts_client().assume_role(RoleArn=role_arn, RoleSessionName='kubectl-handler')['Credentials']
+    session = botocore.session.get_session()
+    session.set_credentials(creds['AccessKeyId'], creds['SecretAccessKey'], creds['SessionToken'])
+    client = session.create_client('sts', region_name=eks_client().meta.region_name)
+
+    def add_cluster_id(request, **kwargs):
+        request.headers['x-k8s-aws-id'] = cluster_name
+
+    client.meta.events.register('before-sign.sts.GetCallerIdentity', add_cluster_id)
+    url = client.generate_presigned_url('get_caller_identity', ExpiresIn=60, HttpMethod='GET')
+    return 'k8s-aws-v1.' + base64.urlsafe_b64encode(url.encode('utf-8')).decode('utf-8').rstrip('=')
+
+def eks_client():
+    global eks
+    if eks is None:
+        eks = botocore.session.get_session().create_client('eks')
+    return eks
+
+def sts_client():
+    global sts
+    if sts is None:
+        sts = botocore.session.get_session().create_client('sts')
+    return sts
+
 def helm(verb, release, chart = None, repo = None, file = None, namespace = None, version = None, wait = False, timeout = None, create_namespace = None):
-    import subprocess
-
-    cmnd = ['helm', verb, release]
-    if not chart is None:
-        cmnd.append(chart)
-    if verb == 'upgrade':
-        cmnd.append('--install')
-    if create_namespace:
-        cmnd.append('--create-namespace')
-    if not repo is None:
-        cmnd.extend(['--repo', repo])
-    if not file is None:
-        cmnd.extend(['--values', file])
-    if not version is None:
-        cmnd.extend(['--version', version])
-    if not namespace is None:
-        cmnd.extend(['--namespace', namespace])
-    if wait:
-        cmnd.append('--wait')
-    if not timeout is None:
-        cmnd.extend(['--timeout', timeout])
-    cmnd.extend(['--kubeconfig', kubeconfig])
+    # boolean flags and (option, value) pairs; values that are None are omitted
+    flags = (('--install', verb == 'upgrade'), ('--create-namespace', create_namespace), ('--wait', wait))
+    options = (('--repo', repo), ('--values', file), ('--version', version), ('--namespace', namespace), ('--timeout', timeout))
+
+    cmnd = ['helm', verb, release] + ([chart] if chart is not None else [])
+    cmnd += [flag for flag, enabled in flags if enabled]
+    cmnd += [arg for option, value in options if value is not None for arg in (option, value)]
+    cmnd += ['--kubeconfig', kubeconfig]
 
     maxAttempts = 3
-    retry = maxAttempts
-    while retry > 0:
+    for attempt in range(maxAttempts):
         try:
-            output = subprocess.check_output(cmnd, stderr=subprocess.STDOUT, cwd=outdir)
-            logger.info(output)
+            stream_output(cmnd)
             return
         except subprocess.CalledProcessError as exc:
             output = exc.output
-            if b'Broken pipe' in output:
-                retry = retry - 1
-                logger.info("Broken pipe, retries left: %s" % retry)
-            else:
+            if not 'Broken pipe' in output:
                 raise Exception(output)
+            retry = maxAttempts - attempt - 1
+            logger.info("Broken pipe, retries left: %s" % retry)
+            if retry > 0:
+                # capped exponential backoff with jitter, so concurrent resources
+                # don't hit the api server in lockstep
+                time.sleep(min(15, (2 ** attempt) * 0.5 + random.random() * 0.25))
     raise Exception(f'Operation failed after {maxAttempts} attempts: {output}')
+
+def stream_output(cmnd):
+    # log helm output as it is produced and only keep the tail around for
+    # error reporting, so memory stays bounded regardless of chart size.
+    tail = collections.deque(maxlen=200)
+    with subprocess.Popen(cmnd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=outdir, bufsize=1, encoding='utf-8', errors='replace') as proc:
+        for line in proc.stdout:
+            line = line.rstrip()
+            logger.info(line)
+            tail.append(line)
+        rc = proc.wait()
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmnd, output='\n'.join(tail))
@@ -7,7 +7,8 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # these are coming from the kubectl layer
-os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
+if '/opt/kubectl' not in os.environ.get('PATH', ''):
+    os.environ['PATH'] = '/opt/kubectl:/opt/awscli:' + os.environ['PATH']
 
 outdir = os.environ.get('TEST_OUTDIR', '/tmp')
 kubeconfig = os.path.join(outdir, 'kubeconfig')
@@ -24,11 +25,15 @@ def patch_handler(event, context):
     role_arn      = props['RoleArn']
 
     # "log in" to the cluster
-    subprocess.check_call([ 'aws', 'eks', 'update-kubeconfig',
-        '--role-arn', role_arn,
-        '--name', cluster_name,
-        '--kubeconfig', kubeconfig
-    ])
+    try:
+        subprocess.run([ 'aws', 'eks', 'update-kubeconfig',
+            '--role-arn', role_arn,
+            '--name', cluster_name,
+            '--kubeconfig', kubeconfig
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    except subprocess.CalledProcessError as exc:
+        logger.error(exc.stderr)
+        raise
 
     if os.path.isfile(kubeconfig):
         os.chmod(kubeconfig, 0o600)